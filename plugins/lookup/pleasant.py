@@ -10,6 +10,60 @@ author: Aleksandar Trkulja
 version_added: "1.0"
 short_description: lookup passwords in Pleasant Password server by GUID.  
    This is using Python Requests https://docs.python-requests.org/en/latest/api/
+requirements:
+  - requests
+  - orjson (optional, faster JSON decoding)
+notes:
+  - Requests are sent over a process wide session per I(pleasant_verify) setting, so the token,
+    entry and password calls reuse pooled keep-alive connections instead of performing a TLS
+    handshake each.
+options:
+  pleasant_host:
+    description: Base URL of the Pleasant Password server, e.g. C(https://pleasant.example.com:10001).
+    type: str
+    required: true
+    vars:
+      - name: pleasant_host
+  pleasant_username:
+    description: User to authenticate against Pleasant with.
+    type: str
+    required: true
+    vars:
+      - name: pleasant_username
+  pleasant_password:
+    description: Password of I(pleasant_username).
+    type: str
+    required: true
+    vars:
+      - name: pleasant_password
+  pleasant_verify:
+    description:
+      - Whether to verify the server's TLS certificate, or the path to a CA bundle to verify it with.
+    type: raw
+    default: true
+    vars:
+      - name: pleasant_verify
+  pleasant_timeout:
+    description:
+      - Fallback timeout in seconds. Caps the connect timeout and is used as read timeout when
+        I(pleasant_read_timeout) is not set.
+    type: float
+    vars:
+      - name: pleasant_timeout
+  pleasant_connect_timeout:
+    description:
+      - Seconds to wait for the TCP connection to Pleasant, kept short so a dead host fails fast.
+      - Defaults to the smaller of I(pleasant_timeout) and 3.05.
+    type: float
+    vars:
+      - name: pleasant_connect_timeout
+  pleasant_read_timeout:
+    description:
+      - Seconds to wait for Pleasant to answer once connected.
+      - Defaults to I(pleasant_timeout), or 15.
+    type: float
+    vars:
+      - name: pleasant_read_timeout
 """
 
 EXAMPLES = """
@@ -22,132 +76,236 @@ RETURN = """
     elements: dict
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import http.cookiejar
+import os
+import threading
+import time
+from urllib.parse import quote
+
 from ansible.errors import AnsibleError
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from ansible.module_utils._text import to_text, to_native
 from ansible.plugins.lookup import LookupBase
-from ansible.utils.display import Display
 
-display = Display()
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# (connect, read) timeout; the connect timeout sits just above a multiple of the 3s TCP retransmit window
+_DEFAULT_TIMEOUT = (3.05, 15)
+
+_ENTRY_URL    = "{0}/api/v5/rest/entries/{1}"
+_PASSWORD_URL = "{0}/api/v5/rest/entries/{1}/password"
+
+_ERR_MSG = {
+    requests.ConnectTimeout: "The request timed out while trying to connect to the remote server. Retry later.",
+    requests.ConnectionError: "Can't connect to host",
+    requests.HTTPError: "An HTTP Error occured",
+    requests.exceptions.RetryError: "Pleasant kept answering with a gateway error",
+    requests.URLRequired: "Invalid url",
+    requests.Timeout: "The request timed out",
+}
+
+
+def _resolve_timeout(timeout, connect_timeout=None, read_timeout=None):
+    """ Return the (connect, read) timeout tuple passed to requests """
+    if timeout:
+        timeout = float(timeout)
+    if not connect_timeout:
+        connect_timeout = min(timeout, _DEFAULT_TIMEOUT[0]) if timeout else _DEFAULT_TIMEOUT[0]
+    if not read_timeout:
+        read_timeout = timeout or _DEFAULT_TIMEOUT[1]
+    return (float(connect_timeout), float(read_timeout))
+
+
+def _error_message(exc):
+    """ Return the message for the most specific requests exception type matching exc """
+    for cls in type(exc).__mro__:
+        if cls in _ERR_MSG:
+            return _ERR_MSG[cls]
+    return "Request failed"
+
+
+def _is_unauthorized(exc):
+    """ Return True if the AnsibleError was raised for a 401 answer from Pleasant """
+    orig = getattr(exc, 'orig_exc', None)
+    response = getattr(orig, 'response', None)
+    return isinstance(orig, requests.HTTPError) and response is not None and response.status_code == 401
+
+
+# upper bound for concurrent requests per lookup, matched by the connection pool size
+_MAX_WORKERS = 8
+
+# verify -> session; one session per verify setting so connections pooled with certificate checks
+# disabled are never reused by a lookup that verifies (requests < 2.32 kept the first request's setting)
+_sessions = {}
+# pid the sessions were created in, so forked workers don't reuse sockets pooled by their parent
+_sessions_pid = None
+_session_lock = threading.Lock()
+
+
+def _get_session(verify):
+    """ Return the process wide requests session for verify, so lookups reuse pooled keep-alive connections """
+    global _sessions_pid
+    with _session_lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+
+        session = _sessions.get(verify)
+        if session is None:
+            session = requests.Session()
+            # the session is shared between credentials, so never store cookies one user's response sets
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            # only retry gateway errors; retrying connect errors and read timeouts would multiply the timeouts,
+            # and read=False keeps a read timeout from being reported as a connection error
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=_MAX_WORKERS,
+                                  max_retries=Retry(total=2, connect=0, read=False, backoff_factor=0.2,
+                                                    status_forcelist=[502, 503, 504]))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[verify] = session
+        return session
+
 
 class LookupModule(LookupBase):
-    def get_token(self, pleasant_host, pleasant_username, pleasant_password, pleasant_verify, pleasant_timeout):
-        verify  = pleasant_verify
-        timeout = pleasant_timeout
+    # access tokens keyed by a hash of (host, username, password) -> (token, expires_at)
+    _token_cache = {}
+    # guards _token_locks; each key gets its own lock so unrelated token fetches don't wait on each other
+    _token_cache_lock = threading.Lock()
+    _token_locks = {}
+
+    def get_cached_token(self, pleasant_host, pleasant_username, pleasant_password, pleasant_verify, pleasant_timeout,
+                         rejected_token=None):
+        """ Return an access token, reusing a cached one until shortly before it expires or Pleasant rejects it """
+        key = hashlib.sha256(repr((pleasant_host, pleasant_username, pleasant_password)).encode("utf-8")).hexdigest()
+
+        with self._token_cache_lock:
+            key_lock = self._token_locks.setdefault(key, threading.Lock())
 
-        if timeout is None: timeout = 5
+        with key_lock:
+            cached = self._token_cache.get(key)
+            if cached is not None and cached[0] != rejected_token and time.monotonic() < cached[1] - 30:
+                return cached[0]
+            self._token_cache.pop(key, None)
 
+            at = self.get_token(pleasant_host, pleasant_username, pleasant_password, pleasant_verify, pleasant_timeout)
+            access_token = at.get('access_token') if isinstance(at, dict) else None
+            if not access_token:
+                raise AnsibleError("Authentication failed getting an access token from Pleasant: no access_token in response")
+            try:
+                expires_in = int(at.get('expires_in', 3600))
+            except (TypeError, ValueError):
+                expires_in = 3600
+            self._token_cache[key] = (access_token, time.monotonic() + expires_in)
+        return access_token
+
+    def _call(self, method, url, failure_msg=None, **kwargs):
+        """ Send a request on the shared session and raise an AnsibleError unless Pleasant answers 200 """
         try:
-            url      = pleasant_host + "/oauth2/token"
-            payload  = f'grant_type=password&username={pleasant_username}&password={pleasant_password}'
-            headers  = {'Content-Type': 'application/x-www-form-urlencoded'}
-            response = requests.request("POST", url, headers=headers, data=payload, verify=verify, timeout=timeout)
+            response = self._session.request(method, url, **kwargs)
 
             if response.status_code != 200:
-                display.display(f"Authentication failed getting an access token from Pleasant {response.status_code} {response.reason}")
+                # the HTTPError message already carries the status code and reason
                 response.raise_for_status()
-        except requests.ConnectionError as e:
-            raise AnsibleError(f"Can't connect to host to get token {to_native(e)}")
-        except requests.HTTPError as e:
-            raise AnsibleError(f"An HTTP Error occured {to_native(e)}")
-        except requests.URLRequired as e:
-            raise AnsibleError(f"Invalid url {to_native(e)}")
-        except requests.ConnectTimeout as e:
-            raise AnsibleError(f"The request timed out while trying to connect to the remote server. Retry later. {to_native(e)}")
-        except requests.Timeout as e:
-            raise AnsibleError(f"The request timed out {to_native(e)}")
+        except requests.RequestException as e:
+            if failure_msg:
+                raise AnsibleError(f"{failure_msg}: {_error_message(e)} {to_native(e)}", orig_exc=e) from e
+            raise AnsibleError(f"{_error_message(e)} {to_native(e)}", orig_exc=e) from e
+        return response
+
+    def get_token(self, pleasant_host, pleasant_username, pleasant_password, pleasant_verify, pleasant_timeout):
+        timeout = pleasant_timeout
+        if not timeout: timeout = _DEFAULT_TIMEOUT
+
+        url      = pleasant_host + "/oauth2/token"
+        # requests form-encodes the dict and sets the Content-Type header
+        payload  = {"grant_type": "password", "username": pleasant_username, "password": pleasant_password}
+        response = self._call("POST", url, "Authentication failed getting an access token from Pleasant",
+                              data=payload, verify=pleasant_verify, timeout=timeout)
 
         try:
-            pleasant_at = response.json()
+            pleasant_at = json_loads(response.content)
         except Exception as e:
-            raise AnsibleError(f"can't decode access token : {pleasant_at} , {to_native(e)}")
+            raise AnsibleError(f"can't decode access token : {to_native(e)}")
         return pleasant_at
 
-    def get_pps_entry(self, pleasant_host, guid, verify, timeout, pleasant_at):
-        url = f'{pleasant_host}/api/v5/rest/entries/{guid}'
-        headers = {"Content-type": "application/json", "Authorization": "Bearer " + pleasant_at}
+    def get_pps_entry(self, pleasant_host, guid, verify, timeout, headers):
+        url = _ENTRY_URL.format(pleasant_host, guid)
 
-        if not timeout: timeout = 5
+        if not timeout: timeout = _DEFAULT_TIMEOUT
 
-        try:
-            response = requests.request("GET", url,
-                                        headers=headers, verify=verify, timeout=timeout)
-            if response.status_code != 200:
-                display.display(f"Getting crredential failed: ({response.status_code} {response.reason})")
-                response.raise_for_status()
-        except requests.ConnectionError as e:
-            raise AnsibleError(f"Can't connect to host to get token {to_native(e)}")
-        except requests.HTTPError as e:
-            raise AnsibleError(f"An HTTP Error occured {to_native(e)}")
-        except requests.URLRequired as e:
-            raise AnsibleError(f"Invalid url {to_native(e)}")
-        except requests.ConnectTimeout as e:
-            raise AnsibleError(f"The request timed out while trying to connect to the remote server. Retry later. {to_native(e)}")
-        except requests.Timeout as e:
-            raise AnsibleError(f"The request timed out {to_native(e)}")
-        except Exception as e:
-            raise AnsibleError(f"Failed to execute get_pps_entry: error {to_native(e)}")
-        return response
+        return self._call("GET", url, "Getting credential failed", headers=headers, verify=verify, timeout=timeout)
 
-    def get_password(self, pleasant_host, pleasant_id, verify, timeout, pleasant_at):
-        url = f"{pleasant_host}/api/v5/rest/entries/{pleasant_id}/password"
-        headers = {"Content-type": "application/json", "Authorization": "Bearer " + pleasant_at}
+    def get_password(self, pleasant_host, pleasant_id, verify, timeout, headers):
+        url = _PASSWORD_URL.format(pleasant_host, pleasant_id)
 
-        if not timeout: timeout = 5
+        if not timeout: timeout = _DEFAULT_TIMEOUT
 
+        return self._call("GET", url, headers=headers, verify=verify, timeout=timeout)
+
+    def _lookup_terms(self, pps_host, terms, verify, timeout, access_token):
+        """ Fetch the entry and password of every term with the given access token """
+        ret = []
+        # built once per lookup and shared by all requests; the session itself is shared
+        # between hosts and credentials, so the Authorization header is not stored on it
+        headers = {"Content-type": "application/json", "Authorization": "Bearer " + access_token}
         try:
-            response = requests.request("GET", url, headers=headers, verify=verify, timeout=timeout)
+            # the entry and password requests are independent, fan them out over the pooled connections
+            with ThreadPoolExecutor(max_workers=min(_MAX_WORKERS, 2 * len(terms))) as executor:
+                futures = []
+                for term in terms:
+                    guid = quote(term, safe='')
+                    futures.append((executor.submit(self.get_pps_entry, pps_host, guid, verify, timeout, headers),
+                                    executor.submit(self.get_password, pps_host, guid, verify, timeout, headers)))
 
-            if response.status_code != 200:
-                response.raise_for_status()
-        except requests.ConnectionError as e:
-            raise AnsibleError(f"Can't connect to host to get token {to_native(e)}")
-        except requests.HTTPError as e:
-            raise AnsibleError(f"An HTTP Error occured {to_native(e)}")
-        except requests.URLRequired as e:
-            raise AnsibleError(f"Invalid url {to_native(e)}")
-        except requests.ConnectTimeout as e:
-            raise AnsibleError(f"The request timed out while trying to connect to the remote server. Retry later. {to_native(e)}")
-        except requests.Timeout as e:
-            raise AnsibleError(f"The request timed out {to_native(e)}")
+                try:
+                    for entry_future, passwd_future in futures:
+                        entry  = json_loads(entry_future.result().content)
+                        passwd = json_loads(passwd_future.result().content)
+
+                        idusername = entry.get("Username")
+
+                        ret.append({"username": to_text(idusername), "password": to_text(passwd)})
+                except BaseException:
+                    # drop the queued requests so leaving the executor only waits for the ones in flight
+                    for pair in futures:
+                        for future in pair:
+                            future.cancel()
+                    raise
+
+        except AnsibleError:
+            raise
         except Exception as e:
-            raise AnsibleError(f"Failed to get password {pleasant_id} - error {to_native(e)}")
-        return response
+            raise AnsibleError(f"No entry found {to_native(e)}")
+        return ret
 
     def run(self, terms, variables=None, **kwargs):
         self.set_options(var_options=variables, direct=kwargs)
+        pps_host = self.get_option('pleasant_host')
+        username = self.get_option('pleasant_username')
+        password = self.get_option('pleasant_password')
+        verify   = self.get_option('pleasant_verify')
+        timeout  = _resolve_timeout(self.get_option('pleasant_timeout'),
+                                    self.get_option('pleasant_connect_timeout'),
+                                    self.get_option('pleasant_read_timeout'))
+        self._session = _get_session(verify)
 
-        ret = []
-        pps_host = variables.get('pleasant_host')
-        username = variables.get('pleasant_username')
-        password = variables.get('pleasant_password')
-        verify   = variables.get('pleasant_verify')
-        timeout  = variables.get('pleasant_timeout')
-        guid     = terms[0]
-
-        at = self.get_token(pps_host, username, password, verify, timeout)
+        if not terms:
+            return []
+
+        access_token = self.get_cached_token(pps_host, username, password, verify, timeout)
         try:
-            access_token = at.get('access_token', 'default')
-            retval = self.get_pps_entry(pps_host, guid, verify, timeout, access_token)
-            entry = retval.json()
-            
-            retval = self.get_password(pps_host, guid, verify, timeout, access_token)
-            passwd = retval.json()
-
-            idusername = entry.get("Username")
-
-            ret.append({"username": to_text(idusername), "password": to_text(passwd)})
-
-        except requests.ConnectionError as e:
-            raise AnsibleError(f"Can't connect to host to get token {to_native(e)}")
-        except requests.HTTPError as e:
-            raise AnsibleError(f"An HTTP Error occured {to_native(e)}")
-        except requests.URLRequired as e:
-            raise AnsibleError(f"Invalid url: {to_native(e)}")
-        except requests.ConnectTimeout as e:
-            raise AnsibleError(f"The request timed out while trying to connect to the remote server. Retry later: {to_native(e)}")
-        except requests.Timeout as e:
-            raise AnsibleError(f"The request timed out: {to_native(e)}")
-        except Exception as e:
-            raise AnsibleError(f"No entry found {to_native(e)}")
-        return ret
\ No newline at end of file
+            return self._lookup_terms(pps_host, terms, verify, timeout, access_token)
+        except AnsibleError as e:
+            if not _is_unauthorized(e):
+                raise
+
+        # the cached token was revoked or the server restarted, log in again once
+        access_token = self.get_cached_token(pps_host, username, password, verify, timeout, rejected_token=access_token)
+        return self._lookup_terms(pps_host, terms, verify, timeout, access_token)